@@ -1,15 +1,27 @@
 from fastapi import FastAPI, File, UploadFile, HTTPException, BackgroundTasks
 from fastapi.responses import StreamingResponse
 import boto3
+from botocore.config import Config
 from botocore.exceptions import NoCredentialsError
+import asyncio
 import uuid
 import re
 import os
 import csv
-from io import StringIO, BytesIO, TextIOWrapper
-from pydantic import BaseModel
+import codecs
+import multiprocessing
+import threading
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from io import StringIO, BytesIO
+from functools import lru_cache
+from typing import Annotated, Optional, Tuple
+from pydantic import BaseModel, Field, field_validator
+from pydantic_settings import BaseSettings, NoDecode, SettingsConfigDict
 from dotenv import load_dotenv
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from PIL import Image
 
 # Load environment variables from .env file
@@ -17,28 +29,65 @@ load_dotenv()
 
 app = FastAPI()
 
-# AWS DynamoDB configuration
-AWS_ACCESS_KEY_ID = os.getenv("AWS_ACCESS_KEY_ID")
-AWS_SECRET_ACCESS_KEY = os.getenv("AWS_SECRET_ACCESS_KEY")
-AWS_REGION = os.getenv("AWS_REGION")
-AWS_BUCKET_NAME = os.getenv("AWS_BUCKET_NAME")
-AWS_IMAGE_BUCKET = os.getenv("AWS_IMAGE_BUCKET")
-DYNAMO_TABLE_NAME = os.getenv("DYNAMO_TABLE_NAME")
-VALID_HEADERS = os.getenv("VALID_HEADERS").split(",")
-MAX_FILE_SIZE = int(os.getenv("MAX_FILE_SIZE"))
-IMAGE_QUALITY = int(os.getenv("IMAGE_QUALITY"))
+class Settings(BaseSettings):
+    model_config = SettingsConfigDict(frozen=True)
+
+    # AWS DynamoDB configuration
+    AWS_ACCESS_KEY_ID: Optional[str] = None
+    AWS_SECRET_ACCESS_KEY: Optional[str] = None
+    AWS_REGION: Optional[str] = None
+    AWS_BUCKET_NAME: str
+    AWS_IMAGE_BUCKET: str
+    DYNAMO_TABLE_NAME: str
+    VALID_HEADERS: Annotated[Tuple[str, ...], NoDecode] = ("S.No.", "Product Name", "Input Image Urls")
+    MAX_FILE_SIZE: int = Field(2_097_152, gt=0)
+    IMAGE_QUALITY: int = Field(50, ge=1, le=100)
+    PNG_COMPRESS_LEVEL: int = Field(6, ge=0, le=9)
+
+    @field_validator("VALID_HEADERS", mode="before")
+    @classmethod
+    def split_headers(cls, value):
+        if isinstance(value, str):
+            return tuple(value.split(","))
+        return value
+
+@lru_cache
+def get_settings() -> Settings:
+    # Parsed and validated once per process so missing config fails at startup
+    return Settings()
+
+MAX_WORKERS = 32
+UPLOAD_CHUNK_SIZE = 64 * 1024
 
 s3_client = boto3.client('s3',
-                         aws_access_key_id=AWS_ACCESS_KEY_ID,
-                         aws_secret_access_key=AWS_SECRET_ACCESS_KEY,
-                         region_name=AWS_REGION)
+                         aws_access_key_id=get_settings().AWS_ACCESS_KEY_ID,
+                         aws_secret_access_key=get_settings().AWS_SECRET_ACCESS_KEY,
+                         region_name=get_settings().AWS_REGION,
+                         config=Config(max_pool_connections=64,
+                                       retries={"max_attempts": 5, "mode": "adaptive"}))
 
 dynamodb = boto3.resource('dynamodb',
-                          region_name=AWS_REGION,
-                          aws_access_key_id=AWS_ACCESS_KEY_ID,
-                          aws_secret_access_key=AWS_SECRET_ACCESS_KEY)
+                          region_name=get_settings().AWS_REGION,
+                          aws_access_key_id=get_settings().AWS_ACCESS_KEY_ID,
+                          aws_secret_access_key=get_settings().AWS_SECRET_ACCESS_KEY)
 
-table = dynamodb.Table(DYNAMO_TABLE_NAME)
+table = dynamodb.Table(get_settings().DYNAMO_TABLE_NAME)
+
+# Shared HTTP session so image fetches reuse keep-alive connections
+SESSION = requests.Session()
+_adapter = HTTPAdapter(pool_connections=64, pool_maxsize=64, max_retries=Retry(total=3, backoff_factor=0.2))
+SESSION.mount("https://", _adapter)
+SESSION.mount("http://", _adapter)
+
+# Image encode pool shared across requests, created on first use
+_encode_pool = None
+_encode_pool_lock = threading.Lock()
+
+# Regular expression to match alphanumeric characters and spaces
+ALNUM_PATTERN = re.compile(r'^[a-zA-Z0-9 ]*$')
+# Regex pattern for validating a comma separated list of URLs that end with common image formats
+IMAGE_URL = r'(?:http|https)://[^\s,/$.?#][^,\n][^\s,]*\.(?:jpg|jpeg|png|gif)'
+IMAGE_URL_LIST_PATTERN = re.compile(rf'\s*{IMAGE_URL}\s*(?:,\s*{IMAGE_URL}\s*)*', re.IGNORECASE)
 
 class Item(BaseModel):
     requestId: str
@@ -78,67 +127,82 @@ def upload_to_s3(file, requestId: str, replace = False) -> None:
         }
 
     try:
-        s3_client.upload_fileobj(file if replace else file.file, AWS_BUCKET_NAME, file_key, ExtraArgs={"Metadata": s3_metadata}) 
+        s3_client.upload_fileobj(file if replace else file.file, get_settings().AWS_BUCKET_NAME, file_key, ExtraArgs={"Metadata": s3_metadata})
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error occurred while writing file to S3: {str(e)}")
 
 def upload_image_to_s3(file: BytesIO, image_extension: str) -> str:
-    file_key = f'{str(uuid.uuid4()).replace("-", "")}.{image_extension}'
+    file_key = f'{uuid.uuid4().hex}.{image_extension}'
     s3_metadata = {
         'Content-Type': f"image/{image_extension}"
     }
 
     try:
-        s3_client.upload_fileobj(file, AWS_IMAGE_BUCKET, file_key, ExtraArgs={"Metadata": s3_metadata})
-        return f"https://{AWS_IMAGE_BUCKET}.s3.{AWS_REGION}.amazonaws.com/{file_key}"
+        s3_client.upload_fileobj(file, get_settings().AWS_IMAGE_BUCKET, file_key, ExtraArgs={"Metadata": s3_metadata})
+        return f"https://{get_settings().AWS_IMAGE_BUCKET}.s3.{get_settings().AWS_REGION}.amazonaws.com/{file_key}"
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error occurred while uploading image to S3: {str(e)}")
 
-def read_from_s3(requestId: str) -> str:
+def read_from_s3(requestId: str):
     print(f"Reading from S3 for requestId: {requestId}")
     file_key = f"{requestId}.csv"
-    response = s3_client.get_object(Bucket=AWS_BUCKET_NAME, Key=file_key)
-    file_content = response['Body'].read()
-    return file_content
+    response = s3_client.get_object(Bucket=get_settings().AWS_BUCKET_NAME, Key=file_key)
+    # Decode the body as it streams instead of buffering the whole object
+    return codecs.getreader('utf-8')(response['Body'])
  
 def process_file(requestId: str):
     print(f"Processing started for requestId: {requestId}")
     try:
-        item = Item(
-            requestId=requestId,
-            status="Processing in progress!"
-        )
-        write_to_db(item)
-
-        file_content = read_from_s3(requestId)
-        csv_reader = csv.reader(StringIO(file_content.decode('utf-8')))
+        csv_reader = csv.reader(read_from_s3(requestId))
         headers = next(csv_reader)
         headers.append("Output Image Urls")
 
-        new_csv = [[headers]]
-        for row in csv_reader:
-            print(f"Processing row: {row}")
-            image_urls = row[2].split(",")
-            uploaded_urls = [compress_image(url) for url in image_urls]
-            row.append(uploaded_urls)
-            new_csv.append(row)
-        
-        # Convert list of lists to CSV
-        csv_buffer = BytesIO()
-        text_stream = TextIOWrapper(csv_buffer, encoding='utf-8', newline='')
-        csv_writer = csv.writer(text_stream)
-        csv_writer.writerows(new_csv)
-        text_stream.flush()
-        csv_buffer.seek(0)
+        rows = list(csv_reader)
+        tasks = [(i, j, url) for i, row in enumerate(rows) for j, url in enumerate(row[2].split(","))]
+        results = [[None] * len(row[2].split(",")) for row in rows]
+
+        # Compress all images across the CSV concurrently
+        # Downloads and uploads run on threads, encoding runs on the shared process pool
+        with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+            # Repeated urls share one in-flight future instead of being compressed again
+            futures_by_url = {}
+            futures = []
+            for i, j, url in tasks:
+                url = url.strip()
+                if url not in futures_by_url:
+                    futures_by_url[url] = executor.submit(compress_image, url)
+                futures.append((i, j, url, futures_by_url[url]))
+            failed = 0
+            for i, j, url, future in futures:
+                try:
+                    results[i][j] = future.result()
+                except Exception as e:
+                    failed += 1
+                    print(f"Compression failed for url: {url} due to {str(e)}")
+
+        if failed == len(tasks):
+            raise Exception(f"all {failed} images failed to compress")
+
+        csv_text = StringIO()
+        csv_writer = csv.writer(csv_text)
+        csv_writer.writerow(headers)
+        for row, uploaded_urls in zip(rows, results):
+            # Keep output urls aligned with the input list; failed images are left blank
+            row.append(",".join(url or "" for url in uploaded_urls))
+            csv_writer.writerow(row)
+
+        csv_buffer = BytesIO(csv_text.getvalue().encode('utf-8'))
 
         upload_to_s3(csv_buffer, requestId, replace=True)
-        text_stream.close()
 
+        status = "Processing completed successfully!"
+        if failed:
+            status = f"Processing completed with {failed}/{len(tasks)} images failed!"
         item = Item(
             requestId=requestId,
-            status=f"Processing completed successfully!"
+            status=status
         )
-        print(f"Processing completed successfully for requestId: {requestId}")
+        print(f"{status} requestId: {requestId}")
         write_to_db(item)
     except Exception as e:
         item = Item(
@@ -148,25 +212,96 @@ def process_file(requestId: str):
         print(f"Processing failed: {str(e)}")
         write_to_db(item)
 
-def compress_image(url: str) -> str:
-    response = requests.get(url)
-    response.raise_for_status()  # Raise an error for bad responses
-    
-    # Compress the image by 50% of its original quality
-    image = Image.open(BytesIO(response.content))
+def encode_image(data: bytes, quality: int, png_compress_level: int) -> tuple:
+    image = Image.open(BytesIO(data))
     output_io = BytesIO()
 
     if image.format in ['JPEG', 'JPG']:
-        image.save(output_io, format='JPEG', quality=IMAGE_QUALITY)
+        image.save(output_io, format='JPEG', quality=quality, optimize=True, progressive=True)
     elif image.format == 'PNG':
+        # Photographic PNGs without transparency are much smaller and cheaper to
+        # encode as JPEG, but line art and text are not, so only keep the JPEG
+        # when it beats the original PNG
+        if is_opaque(image):
+            image.convert('RGB').save(output_io, format='JPEG', quality=quality, optimize=True, progressive=True)
+            if output_io.tell() < len(data):
+                return output_io.getvalue(), 'jpeg'
+            output_io = BytesIO()
+
         # compress_level: 0 (no compression) to 9 (maximum compression)
-        image.save(output_io, format='PNG', compress_level=IMAGE_QUALITY // 10) 
+        image.save(output_io, format='PNG', compress_level=png_compress_level)
     else:
         # For formats that do not support compression, just save as is
         image.save(output_io, format=image.format)
 
-    output_io.seek(0)
-    return upload_image_to_s3(output_io, image.format.lower())
+    return output_io.getvalue(), image.format.lower()
+
+def is_opaque(image: Image.Image) -> bool:
+    # Palette and colour-key (tRNS) transparency only shows up as alpha after conversion
+    if 'transparency' in image.info:
+        image = image.convert('RGBA')
+    if 'A' not in image.getbands():
+        return True
+    return image.getchannel('A').getextrema() == (255, 255)
+
+def get_encode_pool() -> ProcessPoolExecutor:
+    global _encode_pool
+    with _encode_pool_lock:
+        if _encode_pool is None:
+            # forkserver avoids forking the multi-threaded server process where available
+            mp_context = None
+            if "forkserver" in multiprocessing.get_all_start_methods():
+                mp_context = multiprocessing.get_context("forkserver")
+            _encode_pool = ProcessPoolExecutor(max_workers=os.cpu_count(), mp_context=mp_context)
+        return _encode_pool
+
+def reset_encode_pool(broken_pool: ProcessPoolExecutor) -> None:
+    global _encode_pool
+    with _encode_pool_lock:
+        # Only the first thread to notice the broken pool replaces it
+        if _encode_pool is not broken_pool:
+            return
+        _encode_pool = None
+    broken_pool.shutdown(wait=False)
+
+def compress_image(url: str) -> str:
+    with SESSION.get(url, stream=True, timeout=(3, 10)) as response:
+        response.raise_for_status()  # Raise an error for bad responses
+        data = response.content
+
+    # Encode in a worker process so CPU work isn't bound by the GIL
+    args = (encode_image, data, get_settings().IMAGE_QUALITY, get_settings().PNG_COMPRESS_LEVEL)
+    pool = get_encode_pool()
+    try:
+        output, image_extension = pool.submit(*args).result()
+    except BrokenProcessPool:
+        # A worker died (e.g. OOM on a huge image); rebuild the pool and retry once
+        reset_encode_pool(pool)
+        output, image_extension = get_encode_pool().submit(*args).result()
+
+    return upload_image_to_s3(BytesIO(output), image_extension)
+
+def get_upload_size(file: UploadFile) -> int:
+    # Starlette populates size from the request; fall back to a bounded chunked read
+    if file.size is not None:
+        return file.size
+
+    size = 0
+    while chunk := file.file.read(UPLOAD_CHUNK_SIZE):
+        size += len(chunk)
+        if size > get_settings().MAX_FILE_SIZE:
+            break
+
+    # Reset file pointer to the beginning after reading
+    file.file.seek(0)
+    return size
+
+def stream_s3_body(body):
+    # Close the S3 body whether the download completes or is aborted
+    try:
+        yield from body.iter_chunks(chunk_size=UPLOAD_CHUNK_SIZE)
+    finally:
+        body.close()
 
 @app.post("/upload-csv", summary="Upload a CSV file with a maximum size of 2 MB")
 async def upload_csv(file: UploadFile, background_tasks: BackgroundTasks) -> dict:
@@ -174,30 +309,27 @@ async def upload_csv(file: UploadFile, background_tasks: BackgroundTasks) -> dic
     if file.content_type != 'text/csv':
         raise HTTPException(status_code=400, detail="Only CSV files are allowed")
     
-    if file.file._file.seek(0, 2) > MAX_FILE_SIZE:
+    if await asyncio.to_thread(get_upload_size, file) > get_settings().MAX_FILE_SIZE:
         raise HTTPException(status_code=400, detail="File size exceeds the 2 MB limit!")
 
-    # Reset file pointer to the beginning after reading
-    file.file.seek(0)
-
     try:
-        validate_csv(file.file)
+        await asyncio.to_thread(validate_csv, file.file)
     except HTTPException as ex:
         raise ex
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"CSV parsing failed with exception: {str(e)}")
 
-    requestId = str(uuid.uuid4()).replace("-", "")
+    requestId = uuid.uuid4().hex
     
     print(f"Uploading file to S3: {file.filename}")
-    upload_to_s3(file, requestId)
+    await asyncio.to_thread(upload_to_s3, file, requestId)
 
     item = Item(
         requestId=requestId,
         status="Processing Pending"
     )
     print(f"Writing status to DB: {item}")
-    write_to_db(item)
+    await asyncio.to_thread(write_to_db, item)
 
     # Send to background tasks for processing
     background_tasks.add_task(process_file, requestId)
@@ -206,16 +338,14 @@ async def upload_csv(file: UploadFile, background_tasks: BackgroundTasks) -> dic
     
 @app.get("/status/{requestId}", summary="Get the status of a requestId")
 async def get_status(requestId: str) -> dict:
-    return read_from_db(requestId)
+    return await asyncio.to_thread(read_from_db, requestId)
 
 @app.get("/get-csv/{requestId}", summary="Get the CSV file with compressed image urls after processing is completed")
 async def get_csv(requestId: str):
     try:
         s3_key = f"{requestId}.csv"
-        s3_object = s3_client.get_object(Bucket=AWS_BUCKET_NAME, Key=s3_key)
-        csv_content = s3_object['Body'].read()
-        csv_stream = BytesIO(csv_content)
-        return StreamingResponse(csv_stream, media_type='text/csv', headers={"Content-Disposition": f"attachment; filename={s3_key.split('/')[-1]}"})
+        s3_object = await asyncio.to_thread(s3_client.get_object, Bucket=get_settings().AWS_BUCKET_NAME, Key=s3_key)
+        return StreamingResponse(stream_s3_body(s3_object['Body']), media_type='text/csv', headers={"Content-Disposition": f"attachment; filename={s3_key.split('/')[-1]}"})
 
     except s3_client.exceptions.NoSuchKey:
         raise HTTPException(status_code=404, detail=f"File: {requestId}.csv not found in S3")
@@ -223,19 +353,18 @@ async def get_csv(requestId: str):
         raise HTTPException(status_code=500, detail=str(e))
     
 def validate_csv(file) -> None:
-    file_content = file.read()
-    csv_reader = csv.reader(StringIO(file_content.decode('utf-8')))
+    csv_reader = csv.reader(codecs.getreader('utf-8')(file))
 
-    row_count = sum(1 for _ in csv_reader)
-    if row_count <= 1:
+    headers = next(csv_reader, None)
+    if headers is None:
         raise HTTPException(status_code=400, detail="CSV file is empty")
+    valid_headers = list(get_settings().VALID_HEADERS)
+    if headers != valid_headers:
+        raise HTTPException(status_code=400, detail=f"CSV file headers are invalid. Allowed headers are {valid_headers}")
 
-    csv_reader = csv.reader(StringIO(file_content.decode('utf-8')))
-    headers = next(csv_reader)
-    if headers != VALID_HEADERS:
-        raise HTTPException(status_code=400, detail=f"CSV file headers are invalid. Allowed headers are {VALID_HEADERS}")
-
+    has_rows = False
     for row in csv_reader:
+        has_rows = True
         if len(row) < 3:
             raise HTTPException(status_code=400, detail=f"Row has insufficient columns: {row}")
 
@@ -250,18 +379,16 @@ def validate_csv(file) -> None:
             raise HTTPException(status_code=400, detail=f"Invalid product name (not alphanumeric): {product_name} at S.No.: {sno}")
         
         # Validate image_url
-        image_urls_list = image_urls.split(',')
-        if not all(is_valid_image_url(url.strip()) for url in image_urls_list):
+        if not is_valid_image_url_list(image_urls):
             raise HTTPException(status_code=400, detail=f"Invalid Image Urls in list: {image_urls} at S.No.: {sno}")
+
+    if not has_rows:
+        raise HTTPException(status_code=400, detail="CSV file is empty")
         
     file.seek(0)
 
 def is_alphanumeric_with_spaces(s: str) -> bool:
-    # Regular expression to match alphanumeric characters and spaces
-    pattern = r'^[a-zA-Z0-9 ]*$'
-    return re.match(pattern, s) is not None
-
-def is_valid_image_url(url: str) -> bool:
-    # Regex pattern for validating URLs that end with common image formats
-    url_pattern = re.compile(r'^(http|https)://[^\s/$.?#].[^\s]*\.(jpg|jpeg|png|gif)$', re.IGNORECASE)
-    return re.match(url_pattern, url) is not None
+    return ALNUM_PATTERN.match(s) is not None
+
+def is_valid_image_url_list(urls: str) -> bool:
+    return IMAGE_URL_LIST_PATTERN.fullmatch(urls) is not None